@@ -1,217 +1,422 @@
 import os
 import sys
 import re
-import subprocess
-from datetime import datetime, timedelta
+import hmac
+import base64
+import binascii
+import hashlib
+import atexit
+import threading
+import time
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
 from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError, LineBotApiError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage, SourceGroup, SourceRoom, SourceUser
-import psycopg2
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from linebot import LineBotApi
+from linebot.http_client import HttpClient, RequestsHttpClient, RequestsHttpResponse
+from linebot.models import MessageEvent, TextSendMessage
+import orjson
 import google.generativeai as genai
 from apscheduler.schedulers.background import BackgroundScheduler
+from db import DB_ENABLED, db_connection
+# 排除的群組在 scheduler.py 解析一次，webhook 與催繳共用同一份
+from scheduler import EXCLUDE_GROUP_IDS, check_reminders
 
 # --- 環境變數設定 ---
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
 LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET')
-DATABASE_URL = os.environ.get('DATABASE_URL')
 GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
-EXCLUDE_GROUP_IDS_STR = os.environ.get('EXCLUDE_GROUP_IDS', '')
-EXCLUDE_GROUP_IDS = set(EXCLUDE_GROUP_IDS_STR.split(',')) if EXCLUDE_GROUP_IDS_STR else set()
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL')
+
+# --- 日誌 ---
+# 寫入 stderr 交給背景 listener 執行緒，webhook 執行緒只負責把紀錄丟進佇列
+log_queue = queue.Queue(-1)
+logger = logging.getLogger("bot")
+logger.setLevel(logging.INFO)
+logger.addHandler(QueueHandler(log_queue))
+logger.propagate = False
+log_listener = QueueListener(log_queue, logging.StreamHandler(sys.stderr))
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # --- 診斷與初始化 ---
 if not LINE_CHANNEL_ACCESS_TOKEN or not LINE_CHANNEL_SECRET:
     sys.exit("Error: LINE Channel Token/Secret is missing!")
 
 # --- 🧠 AI 初始化 ---
+# 聊天用的人設放在 model 的 system_instruction，不必每次呼叫都串進 prompt
+AI_SYSTEM_PROMPT = "你是一個幽默、有點毒舌但很樂於助人的團隊助理 Bot。你的名字叫「摳你錢3000」。"
+# list_models() 選出的模型名稱存在本機檔案，重啟或擴容時不必每次都打一趟 API；GEMINI_MODEL 可直接指定
+MODEL_CACHE_PATH = '/tmp/gemini_model.txt'
+MODEL_CACHE_MAX_AGE = 7 * 24 * 3600
+
+def read_cached_model_name():
+    try:
+        if time.time() - os.path.getmtime(MODEL_CACHE_PATH) < MODEL_CACHE_MAX_AGE:
+            with open(MODEL_CACHE_PATH, encoding='utf-8') as f:
+                return f.read().strip() or None
+    except OSError:
+        pass
+    return None
+
+def discover_model_name():
+    # 優先使用 2.0 Flash
+    priority_list = [
+        'models/gemini-2.0-flash',       
+        'models/gemini-2.0-flash-lite',  
+        'models/gemini-2.5-pro-preview-03-25', 
+        'models/gemini-1.5-flash',
+        'models/gemini-pro'
+    ]
+    
+    available_models = []
+    try:
+        for m in genai.list_models():
+            if 'generateContent' in m.supported_generation_methods:
+                available_models.append(m.name)
+    except Exception:
+        pass 
+
+    selected_model_name = None
+    for p in priority_list:
+        if p in available_models:
+            selected_model_name = p
+            break
+    
+    if not selected_model_name and available_models:
+        selected_model_name = available_models[0]
+
+    if not selected_model_name: return None
+    clean_name = selected_model_name.replace('models/', '')
+    try:
+        with open(MODEL_CACHE_PATH, 'w', encoding='utf-8') as f:
+            f.write(clean_name)
+    except OSError as e:
+        logger.warning("Model name cache write failed: %s", e)
+    return clean_name
+
 model = None
+chat_model = None
 if GOOGLE_API_KEY:
     try:
         genai.configure(api_key=GOOGLE_API_KEY)
-        # 優先使用 2.0 Flash
-        priority_list = [
-            'models/gemini-2.0-flash',       
-            'models/gemini-2.0-flash-lite',  
-            'models/gemini-2.5-pro-preview-03-25', 
-            'models/gemini-1.5-flash',
-            'models/gemini-pro'
-        ]
-        
-        available_models = []
-        try:
-            for m in genai.list_models():
-                if 'generateContent' in m.supported_generation_methods:
-                    available_models.append(m.name)
-        except Exception:
-            pass 
-
-        selected_model_name = None
-        for p in priority_list:
-            if p in available_models:
-                selected_model_name = p
-                break
-        
-        if not selected_model_name and available_models:
-            selected_model_name = available_models[0]
+        clean_name = GEMINI_MODEL or read_cached_model_name() or discover_model_name()
 
-        if selected_model_name:
-            clean_name = selected_model_name.replace('models/', '')
+        if clean_name:
             model = genai.GenerativeModel(clean_name)
-            print(f"✅ Gemini AI initialized using: {clean_name}", file=sys.stderr)
+            # 每日總結要專業客觀，繼續用不帶人設的 model
+            chat_model = genai.GenerativeModel(clean_name, system_instruction=AI_SYSTEM_PROMPT)
+            logger.info("✅ Gemini AI initialized using: %s", clean_name)
         else:
-            print("❌ FATAL: No text generation models found!", file=sys.stderr)
+            logger.error("❌ FATAL: No text generation models found!")
 
     except Exception as e:
-        print(f"WARNING: Gemini AI init failed: {e}", file=sys.stderr)
+        logger.warning("Gemini AI init failed: %s", e)
+
+# 啟動後就不會再變，熱路徑只看這個旗標
+AI_ENABLED = model is not None
+
+# --- LINE API 連線 ---
+class PooledHttpClient(RequestsHttpClient):
+    """SDK 預設每次呼叫都用 requests.post 開新連線；改成共用 Session 保留 keep-alive，省掉 TLS 握手"""
+
+    def __init__(self, timeout=HttpClient.DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        # 只有連線失敗與 GET 的 5xx 會重試；reply token 只能用一次，POST 不重送
+        retry = Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504])
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
 
 app = Flask(__name__)
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, http_client=PooledHttpClient)
+CHANNEL_SECRET_BYTES = LINE_CHANNEL_SECRET.encode('utf-8')
+# 事件處理 (資料庫、AI、回覆) 在背景執行緒跑，/callback 驗完簽章就先回 200
+executor = ThreadPoolExecutor(max_workers=8)
+# 排隊中的 payload 上限：Gemini 卡住時新進的直接丟掉，不讓佇列無限長、回覆也早就超過 reply token 時效
+EVENT_QUEUE_MAX = 200
+event_slots = threading.BoundedSemaphore(EVENT_QUEUE_MAX)
+dropped_events = 0
 
 # --- 工具函式 ---
+def verify_signature(body, signature):
+    """驗證 X-Line-Signature (HMAC-SHA256)：直接比對原始 bytes 的 digest，比對使用 constant-time 的 compare_digest"""
+    try:
+        given = base64.b64decode(signature, validate=True)
+    except (binascii.Error, ValueError):
+        return False
+    return hmac.compare_digest(hmac.new(CHANNEL_SECRET_BYTES, body, hashlib.sha256).digest(), given)
+
+# 回報格式：YYYY.MM.DD (週X) 姓名 + 內容
+REPORT_RE = re.compile(r"^(\d{4}\.\d{2}\.\d{2})\s*(?:[（(].*?[)）])?\s*([^\n]+)([\s\S]*)", re.DOTALL)
+# 名字前綴的括號標籤，例如「(組長) 彼得」：開括號 + 1~10 字 + 閉括號
+NAME_PREFIX_OPEN = frozenset('(（[【')
+NAME_PREFIX_CLOSE = frozenset(')）]】')
+NAME_PREFIX_BREAK = frozenset('()[]')
+# AI 問句中的日期：2025.11.27 / 11/27 / 27號
+FULL_DATE_RE = re.compile(r'(\d{4})[./-](\d{1,2})[./-](\d{1,2})')
+SHORT_DATE_RE = re.compile(r'(\d{1,2})[./月-](\d{1,2})')
+DAY_RE = re.compile(r'(\d{1,2})號')
+DIGITS_RE = re.compile(r'(\d+)')
+# 指令裡的全形括號轉半形，translate 一次走完
+FULLWIDTH_PAREN_TABLE = str.maketrans('（）', '()')
+
+# 台灣時間 (UTC+8) 的今天：只在跨日時重算，不必每次 utcnow() 再加時差
+TW_OFFSET_SECONDS = 8 * 3600
+EPOCH_DATE = date(1970, 1, 1)
+tw_today_cache = (None, None)
+
+def tw_today():
+    global tw_today_cache
+    epoch_day = int((time.time() + TW_OFFSET_SECONDS) // 86400)
+    cached_day, today = tw_today_cache
+    if epoch_day != cached_day:
+        today = EPOCH_DATE + timedelta(days=epoch_day)
+        tw_today_cache = (epoch_day, today)
+    return today
+
+def looks_like_report(text):
+    """便宜的前綴檢查 (YYYY.MM.DD)，擋掉大部分聊天訊息，不必進正規表示式引擎"""
+    return (len(text) >= 10 and text[4] == '.' and text[7] == '.'
+            and text[0:4].isdigit() and text[5:7].isdigit() and text[8:10].isdigit())
+
 def normalize_name(name):
+    """去掉開頭的括號標籤，逐字掃描取代 re.sub (最多看 11 個字)"""
     if not name: return ""
-    return re.sub(r'^\s*[（(\[【][^()\[\]]{1,10}[)）\]】]\s*', '', name).strip()
-
-def get_db_connection():
-    try:
-        return psycopg2.connect(DATABASE_URL, sslmode='require')
-    except Exception as e:
-        print(f"DB CONNECTION ERROR: {e}", file=sys.stderr)
-        return None
+    s = name.strip()
+    if not s or s[0] not in NAME_PREFIX_OPEN: return s
+    end = 0
+    for i in range(1, min(len(s), 12)):
+        c = s[i]
+        if c in NAME_PREFIX_CLOSE and i > 1: end = i
+        if c in NAME_PREFIX_BREAK: break
+    return s[end + 1:].lstrip() if end else s
+
+# --- 名單快取 ---
+# 名單很少變動，但開啟 AI 模式後每則訊息都要拿來比對，快取一段時間；名單異動時清掉
+VIP_CACHE_TTL = 60
+vip_cache = {}
+
+def find_group_vip(cur, group_id, text):
+    """
+    找出訊息中提到的名單成員，回傳 normalized_name (沒有則 None)。
+    名單 (含原名與正規化名) 編成一個交替式 regex 一起快取，一次掃過訊息，不必逐個名字做 in 比對。
+    """
+    entry = vip_cache.get(group_id)
+    if not entry or time.monotonic() - entry[0] >= VIP_CACHE_TTL:
+        cur.execute("SELECT vip_name, normalized_name FROM group_vips WHERE group_id = %s", (group_id,))
+        name_map = {}
+        for v_name, v_norm in cur.fetchall():
+            if not v_norm: continue
+            name_map.setdefault(v_norm, v_norm)
+            if v_name: name_map.setdefault(v_name, v_norm)
+        # 長的名字排前面，「彼得潘」不會被「彼得」搶先匹配
+        matcher = re.compile('|'.join(map(re.escape, sorted(name_map, key=len, reverse=True)))) if name_map else None
+        entry = (time.monotonic(), matcher, name_map)
+        vip_cache[group_id] = entry
+    return match_vip(entry, text)
+
+def match_vip(entry, text):
+    _, matcher, name_map = entry
+    m = matcher.search(text) if matcher else None
+    return name_map[m.group(0)] if m else None
+
+def invalidate_vip_cache(group_id):
+    vip_cache.pop(group_id, None)
 
 # --- AI 與 資料檢索 (RAG) 核心 ---
+# 每則非指令訊息都要查模式，模式很少切換，快取一段時間；set_group_mode 成功後直接寫入
+MODE_CACHE_TTL = 60
+mode_cache = {}
+
 def get_group_mode(group_id):
-    conn = get_db_connection()
-    if not conn: return False
-    try:
+    entry = mode_cache.get(group_id)
+    if entry and time.monotonic() - entry[0] < MODE_CACHE_TTL:
+        return entry[1]
+    with db_connection() as conn:
+        if not conn: return False
         with conn.cursor() as cur:
-            cur.execute("SELECT ai_mode FROM group_configs WHERE group_id = %s", (group_id,))
+            cur.execute("EXECUTE get_group_mode_stmt (%s)", (group_id,))
             res = cur.fetchone()
-            return res[0] if res else False
-    finally:
-        conn.close()
+    mode = res[0] if res else False
+    mode_cache[group_id] = (time.monotonic(), mode)
+    return mode
 
 def set_group_mode(group_id, mode):
-    conn = get_db_connection()
-    if not conn: return "💥 資料庫連線失敗。"
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO group_configs (group_id, ai_mode) VALUES (%s, %s)
-                ON CONFLICT (group_id) DO UPDATE SET ai_mode = EXCLUDED.ai_mode
-            """, (group_id, mode))
-            conn.commit()
-        status = "🤖 智能對話 (AI)" if mode else "🔇 一般安靜 (NORMAL)"
-        return f"🔄 模式已切換為：**{status}**"
-    except Exception as e:
-        return f"💥 設定失敗：{e}"
-    finally:
-        conn.close()
+    with db_connection() as conn:
+        if not conn: return "💥 資料庫連線失敗。"
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO group_configs (group_id, ai_mode) VALUES (%s, %s)
+                    ON CONFLICT (group_id) DO UPDATE SET ai_mode = EXCLUDED.ai_mode
+                """, (group_id, mode))
+                conn.commit()
+            mode_cache[group_id] = (time.monotonic(), mode)
+            status = "🤖 智能對話 (AI)" if mode else "🔇 一般安靜 (NORMAL)"
+            return f"🔄 模式已切換為：**{status}**"
+        except Exception as e:
+            return f"💥 設定失敗：{e}"
+
+# 問「大家」、「總結」這類問題時撈整批回報
+CONTEXT_KEYWORDS = ("大家", "所有", "針對目前", "總結", "分析", "整體", "整理", "彙整", "狀況", "狀態")
+
+def parse_context_date(user_text):
+    """從問句找出要查的日期 (今天/昨天/前天/各種日期寫法)，沒有則 None"""
+    today = tw_today()
+    if "昨天" in user_text:
+        return today - timedelta(days=1)
+    if "今天" in user_text:
+        return today
+    if "前天" in user_text:
+        return today - timedelta(days=2)
+    match_full = FULL_DATE_RE.search(user_text)
+    if match_full:
+        return f"{match_full.group(1)}-{match_full.group(2)}-{match_full.group(3)}"
+    match_short = SHORT_DATE_RE.search(user_text)
+    if match_short:
+        return f"{today.year}-{match_short.group(1)}-{match_short.group(2)}"
+    match_day = DAY_RE.search(user_text)
+    if match_day:
+        return f"{today.year}-{today.month}-{int(match_day.group(1))}"
+    return None
 
 def get_ai_context(group_id, user_text):
     """RAG: 根據問題撈取資料庫心得"""
-    conn = get_db_connection()
-    if not conn: return ""
+    # 日期與關鍵字判斷不需要資料庫，先做完
+    target_date = parse_context_date(user_text)
+    wants_reports = target_date or any(k in user_text for k in CONTEXT_KEYWORDS)
+    # 一般閒聊：名單快取還有效且沒提到任何人，就不必借連線
+    if not wants_reports:
+        entry = vip_cache.get(group_id)
+        if entry and time.monotonic() - entry[0] < VIP_CACHE_TTL and not match_vip(entry, user_text):
+            return ""
+
+    with db_connection() as conn:
+        if not conn: return ""
     
-    context_data = ""
-    try:
-        with conn.cursor() as cur:
-            target_date = None
-            current_time = datetime.utcnow() + timedelta(hours=8)
-            
-            if "昨天" in user_text:
-                target_date = (current_time - timedelta(days=1)).date()
-            elif "今天" in user_text:
-                target_date = current_time.date()
-            elif "前天" in user_text:
-                target_date = (current_time - timedelta(days=2)).date()
-            else:
-                match_full = re.search(r'(\d{4})[./-](\d{1,2})[./-](\d{1,2})', user_text)
-                if match_full:
-                    target_date = f"{match_full.group(1)}-{match_full.group(2)}-{match_full.group(3)}"
-                else:
-                    match_short = re.search(r'(\d{1,2})[./月-](\d{1,2})', user_text)
-                    if match_short:
-                        target_date = f"{current_time.year}-{match_short.group(1)}-{match_short.group(2)}"
-                    else:
-                        match_day = re.search(r'(\d{1,2})號', user_text)
-                        if match_day:
-                            day = int(match_day.group(1))
-                            target_date = f"{current_time.year}-{current_time.month}-{day}"
-
-            keywords_all = ["大家", "所有", "針對目前", "總結", "分析", "整體", "整理", "彙整", "狀況", "狀態"]
-            
-            if any(k in user_text for k in keywords_all) or target_date:
-                sql = "SELECT reporter_name, report_content, report_date FROM reports WHERE group_id = %s"
-                params = [group_id]
+        context_data = ""
+        try:
+            with conn.cursor() as cur:
+                if wants_reports:
+                    # 內容在資料庫端先截斷，長篇心得不必整篇傳過來再丟掉
+                    sql = "SELECT reporter_name, LEFT(report_content, 500), report_date FROM reports WHERE group_id = %s"
+                    params = [group_id]
                 
-                if target_date:
-                    sql += " AND report_date = %s"
-                    params.append(target_date)
-                    period_desc = str(target_date)
-                else:
-                    sql += " ORDER BY created_at DESC LIMIT 10" 
-                    period_desc = "最近"
+                    if target_date:
+                        sql += " AND report_date = %s"
+                        params.append(target_date)
+                        period_desc = str(target_date)
+                    else:
+                        sql += " ORDER BY created_at DESC LIMIT 10" 
+                        period_desc = "最近"
 
-                cur.execute(sql, tuple(params))
-                rows = cur.fetchall()
+                    cur.execute(sql, tuple(params))
+                    rows = cur.fetchall()
                 
-                if rows:
-                    context_data += f"【參考資料：{period_desc} 的團隊回報紀錄】\n"
-                    for r in rows:
-                        d_str = r[2].strftime('%Y-%m-%d') if r[2] else "未知日期"
-                        context_data += f"- {r[0]} ({d_str}): {r[1][:500]}\n"
-                else:
-                    context_data += f"【參考資料】{period_desc} 沒有找到任何回報紀錄。\n"
+                    if rows:
+                        context_data += f"【參考資料：{period_desc} 的團隊回報紀錄】\n"
+                        for r in rows:
+                            d_str = r[2].strftime('%Y-%m-%d') if r[2] else "未知日期"
+                            context_data += f"- {r[0]} ({d_str}): {r[1]}\n"
+                    else:
+                        context_data += f"【參考資料】{period_desc} 沒有找到任何回報紀錄。\n"
             
-            elif not target_date:
-                cur.execute("SELECT vip_name, normalized_name FROM group_vips WHERE group_id = %s", (group_id,))
-                vips = cur.fetchall()
-                
-                found_vip = None
-                for v_name, v_norm in vips:
-                    if v_norm and v_norm in user_text:
-                        found_vip = v_norm
-                        break
-                    elif v_name and v_name in user_text:
-                        found_vip = v_norm
-                        break
+                else:
+                    found_vip = find_group_vip(cur, group_id, user_text)
                 
-                if found_vip:
-                    cur.execute("""
-                        SELECT reporter_name, report_content, report_date 
-                        FROM reports 
-                        WHERE group_id = %s AND normalized_name = %s
-                        ORDER BY report_date DESC LIMIT 1
-                    """, (group_id, found_vip))
-                    row = cur.fetchone()
-                    if row:
-                        context_data += f"【參考資料：{row[0]} 的最新回報】\n內容：{row[1]}\n日期：{row[2]}\n"
-                    else:
-                        context_data += f"【參考資料】資料庫裡還沒有 {found_vip} 的回報紀錄。\n"
+                    if found_vip:
+                        cur.execute("""
+                            SELECT reporter_name, report_content, report_date 
+                            FROM reports 
+                            WHERE group_id = %s AND normalized_name = %s
+                            ORDER BY report_date DESC LIMIT 1
+                        """, (group_id, found_vip))
+                        row = cur.fetchone()
+                        if row:
+                            context_data += f"【參考資料：{row[0]} 的最新回報】\n內容：{row[1]}\n日期：{row[2]}\n"
+                        else:
+                            context_data += f"【參考資料】資料庫裡還沒有 {found_vip} 的回報紀錄。\n"
 
-    except Exception as e:
-        print(f"Context Error: {e}", file=sys.stderr)
-    finally:
-        conn.close()
+        except Exception as e:
+            logger.error("Context Error: %s", e)
     
     return context_data
 
-def chat_with_ai(text, context=""):
-    if not model: return "😵‍💫 AI 暫時無法使用。"
+# --- AI 回覆快取與限流 ---
+# 群組裡常有重複的短句 (「?」、「早安」)，同群組、同問題、同參考資料在 TTL 內直接沿用上次的回答
+AI_CACHE_TTL = 300
+AI_CACHE_MAX = 1024
+# 沒有參考資料的長句多半是一次性的閒聊，不佔快取位置
+AI_CACHE_MAX_CHAT_LEN = 40
+ai_cache = {}  # key -> [建立時間, 回答, 命中次數]
+# 每個群組的 token bucket：每分鐘最多 AI_RATE_LIMIT 次，洗版時不讓 Gemini 拖慢回覆
+AI_RATE_LIMIT = 10
+AI_RATE_WINDOW = 60
+ai_buckets = {}
+ai_lock = threading.Lock()
+
+def ai_rate_allowed(group_id):
+    now = time.monotonic()
+    with ai_lock:
+        tokens, last = ai_buckets.get(group_id, (AI_RATE_LIMIT, now))
+        tokens = min(AI_RATE_LIMIT, tokens + (now - last) * AI_RATE_LIMIT / AI_RATE_WINDOW)
+        allowed = tokens >= 1
+        ai_buckets[group_id] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+CONTEXT_NOTE = "(以上是真實的資料庫紀錄，請根據這些內容回答使用者的問題。)"
+
+def chat_with_ai(group_id, text, context=""):
+    if not AI_ENABLED: return "😵‍💫 AI 暫時無法使用。"
+    # 大小寫、前後空白不同的同一句話共用快取；參考資料可能很長，key 只存 16 bytes 的摘要
+    question = text.strip().lower()
+    key = hashlib.blake2b(f"{group_id}\0{question}\0{context}".encode('utf-8'), digest_size=16).digest()
+    cacheable = bool(context) or len(question) <= AI_CACHE_MAX_CHAT_LEN
+    with ai_lock:
+        entry = ai_cache.get(key)
+        if entry and time.monotonic() - entry[0] < AI_CACHE_TTL:
+            entry[2] += 1
+            return entry[1]
+    # 超過頻率就不回覆，避免 reply token 在排隊中過期
+    if not ai_rate_allowed(group_id): return None
     try:
-        system_prompt = "你是一個幽默、有點毒舌但很樂於助人的團隊助理 Bot。你的名字叫「摳你錢3000」。"
-        user_prompt = ""
-        if context:
-            user_prompt += f"{context}\n\n(以上是真實的資料庫紀錄，請根據這些內容回答使用者的問題。)\n\n"
-        
-        user_prompt += f"使用者問題：{text}\n請用繁體中文簡短回答(若是在做總結，請條列式呈現)："
-        full_prompt = f"{system_prompt}\n\n{user_prompt}"
-        response = model.generate_content(full_prompt)
-        return response.text.strip()
+        # 各段直接當成 parts 送出，不必先串成一個大字串
+        parts = [context, CONTEXT_NOTE] if context else []
+        parts.append(f"使用者問題：{text}\n請用繁體中文簡短回答(若是在做總結，請條列式呈現)：")
+        response = chat_model.generate_content(parts)
+        reply = response.text.strip()
+        if not cacheable: return reply
+        with ai_lock:
+            # 滿了先踢過期的，再踢命中最少的 (LFU)：「幫助」、打招呼這類常見句子會留下來
+            now = time.monotonic()
+            if key not in ai_cache and len(ai_cache) >= AI_CACHE_MAX:
+                del ai_cache[min(ai_cache, key=lambda k: (now - ai_cache[k][0] < AI_CACHE_TTL, ai_cache[k][2]))]
+            ai_cache[key] = [now, reply, 0]
+        return reply
     except Exception as e:
-        print(f"AI ERROR: {e}", file=sys.stderr)
+        logger.error("AI ERROR: %s", e)
         return "😵‍💫 AI 發生錯誤 (請檢查 Log)。"
 
 # --- 每日總結 (AI Summary) 核心邏輯 ---
@@ -220,261 +425,316 @@ def generate_daily_summary(group_id, date_str, target_name=None):
     產生指定日期、指定群組的總結報告。
     支援指定人名過濾。
     """
-    conn = get_db_connection()
-    if not conn: return "💥 資料庫連線失敗。"
+    with db_connection() as conn:
+        if not conn: return "💥 資料庫連線失敗。"
     
-    report_text = ""
-    try:
-        with conn.cursor() as cur:
-            sql = "SELECT reporter_name, report_content FROM reports WHERE group_id = %s AND report_date = %s"
-            params = [group_id, date_str]
+        report_text = ""
+        try:
+            with conn.cursor() as cur:
+                sql = "SELECT reporter_name, report_content FROM reports WHERE group_id = %s AND report_date = %s"
+                params = [group_id, date_str]
             
-            # 如果有指定人名，加入過濾條件
-            if target_name:
-                sql += " AND (reporter_name ILIKE %s OR normalized_name ILIKE %s)"
-                params.extend([f"%{target_name}%", f"%{target_name}%"])
+                # 如果有指定人名，加入過濾條件
+                if target_name:
+                    sql += " AND (reporter_name ILIKE %s OR normalized_name ILIKE %s)"
+                    params.extend([f"%{target_name}%", f"%{target_name}%"])
             
-            sql += " ORDER BY created_at ASC"
+                sql += " ORDER BY created_at ASC"
             
-            cur.execute(sql, tuple(params))
-            rows = cur.fetchall()
+                cur.execute(sql, tuple(params))
+                rows = cur.fetchall()
             
-            if not rows:
-                if target_name:
-                    return f"📭 {date_str} 找不到「{target_name}」的回報紀錄。"
-                return f"📭 {date_str} 找不到任何回報紀錄。"
-
-            # 構建報告
-            title = f"📊 【{date_str}】"
-            title += f"{target_name} 的回報總結" if target_name else "團隊回報總結"
+                if not rows:
+                    if target_name:
+                        return f"📭 {date_str} 找不到「{target_name}」的回報紀錄。"
+                    return f"📭 {date_str} 找不到任何回報紀錄。"
+
+                # 構建報告
+                title = f"📊 【{date_str}】"
+                title += f"{target_name} 的回報總結" if target_name else "團隊回報總結"
             
-            lines = [title, "---------------------------"]
+                lines = [title, "---------------------------"]
             
-            # 使用 AI 進行單篇摘要
-            for name, content in rows:
-                try:
-                    # 簡單摘要 Prompt
-                    p = f"請將以下這份工作日報/心得，總結為一句話(包含重點進度與情緒狀態)，語氣請保持專業客觀，不要使用第一人稱，不要超過50個字：\n\n{content}"
-                    res = model.generate_content(p)
-                    summary = res.text.strip()
-                except:
-                    summary = "(AI摘要失敗)"
+                # 使用 AI 進行單篇摘要
+                for name, content in rows:
+                    # AI 無法使用時不必逐筆呼叫再失敗，直接列出內容開頭
+                    if not AI_ENABLED:
+                        lines.append(f"👤 **{name}**：\n{(content or '')[:50]}")
+                        continue
+                    try:
+                        # 簡單摘要 Prompt
+                        p = f"請將以下這份工作日報/心得，總結為一句話(包含重點進度與情緒狀態)，語氣請保持專業客觀，不要使用第一人稱，不要超過50個字：\n\n{content}"
+                        res = model.generate_content(p)
+                        summary = res.text.strip()
+                    except:
+                        summary = "(AI摘要失敗)"
                 
-                lines.append(f"👤 **{name}**：\n{summary}")
+                    lines.append(f"👤 **{name}**：\n{summary}")
             
-            lines.append("---------------------------")
-            lines.append(f"(共 {len(rows)} 筆紀錄)")
-            report_text = "\n".join(lines)
+                lines.append("---------------------------")
+                lines.append(f"(共 {len(rows)} 筆紀錄)")
+                report_text = "\n".join(lines)
 
-    except Exception as e:
-        print(f"Summary Error: {e}", file=sys.stderr)
-        return "💥 產生總結報告時發生錯誤。"
-    finally:
-        conn.close()
+        except Exception as e:
+            logger.error("Summary Error: %s", e)
+            return "💥 產生總結報告時發生錯誤。"
         
     return report_text
 
 # --- 資料庫操作：名單管理 & 回報 ---
+VIP_LIST_LIMIT = 200
+
 def manage_vip_list(group_id, vip_name, action):
-    conn = get_db_connection()
-    if not conn: return "💥 連線失敗。"
-    
     if vip_name and (len(vip_name) < 1 or vip_name in ['(', '（']):
         return "❓ 請輸入有效的人名。"
 
     normalized = normalize_name(vip_name) if vip_name else None
+
+    with db_connection() as conn:
+        if not conn: return "💥 連線失敗。"
     
-    try:
         with conn.cursor() as cur:
             if action == 'ADD':
                 cur.execute("""
-                    INSERT INTO group_vips (group_id, vip_name, normalized_name) 
-                    VALUES (%s, %s, %s) 
+                    INSERT INTO group_vips (group_id, vip_name, normalized_name)
+                    VALUES (%s, %s, %s)
                     ON CONFLICT (group_id, normalized_name) DO NOTHING
                 """, (group_id, vip_name, normalized))
                 conn.commit()
+                invalidate_vip_cache(group_id)
                 return f"🎉 {vip_name} 已加入名單！"
             
             elif action == 'DEL':
                 cur.execute("DELETE FROM group_vips WHERE group_id = %s AND normalized_name = %s", (group_id, normalized))
                 conn.commit()
+                invalidate_vip_cache(group_id)
                 return f"🗑️ {vip_name} 已移除。"
 
             elif action == 'LIST':
-                cur.execute("SELECT vip_name FROM group_vips WHERE group_id = %s ORDER BY vip_name", (group_id,))
-                vips = [row[0] for row in cur.fetchall()]
-                valid_vips = [v for v in vips if v and v not in ['（', '(', ' ']]
+                # 去重、過濾無效名字、排序與組字串都交給資料庫，只拿回一列；
+                # 限制筆數，名單再大也不會超過 LINE 單則 5000 字的上限；多取一筆只用來判斷有沒有被截掉
+                cur.execute("""
+                    SELECT string_agg('🔸 ' || vip_name, E'\\n' ORDER BY vip_name) FILTER (WHERE rn <= %s), count(*)
+                    FROM (
+                        SELECT vip_name, row_number() OVER (ORDER BY vip_name) AS rn
+                        FROM (
+                            SELECT DISTINCT vip_name FROM group_vips
+                            WHERE group_id = %s AND vip_name NOT IN ('', '（', '(', ' ')
+                        ) d
+                        ORDER BY vip_name LIMIT %s
+                    ) v
+                """, (VIP_LIST_LIMIT, group_id, VIP_LIST_LIMIT + 1))
+                list_str, count = cur.fetchone()
                 
-                if valid_vips:
-                    display_list = sorted(list(set(valid_vips)))
-                    list_str = "\n".join([f"🔸 {name}" for name in display_list])
+                if list_str:
+                    if count > VIP_LIST_LIMIT:
+                        list_str += f"\n…（只列出前 {VIP_LIST_LIMIT} 位）"
                     return f"📋 最新回報觀察名單：\n{list_str}\n\n（嗯，看起來大家都還活著。）"
                 return "📭 名單空空如也～"
-    finally:
-        conn.close()
 
 def log_report(group_id, date_str, reporter_name, content):
-    conn = get_db_connection()
-    if not conn: return "💥 連線失敗。"
-    
     reporter_name = reporter_name.strip()
     if not reporter_name or reporter_name in ['（', '(']:
          return "⚠️ 名字解析失敗，請確認格式：YYYY.MM.DD (週X) 姓名"
 
     normalized = normalize_name(reporter_name)
+
+    with db_connection() as conn:
+        if not conn: return "💥 連線失敗。"
     
-    try:
-        r_date = datetime.strptime(date_str, '%Y.%m.%d').date()
-        with conn.cursor() as cur:
-            # 1. 自動補名單
-            cur.execute("""
-                INSERT INTO group_vips (group_id, vip_name, normalized_name) 
-                VALUES (%s, %s, %s) 
-                ON CONFLICT (group_id, normalized_name) DO NOTHING
-            """, (group_id, reporter_name, normalized))
+        try:
+            # 格式已由 looks_like_report 確認，直接切片轉數字，date() 會檢查月日範圍
+            r_date = date(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]))
+            with conn.cursor() as cur:
+                # 自動補名單 + 檢查重複 + 寫入紀錄，合併成單一語句 (一趟網路往返，見 PREPARED_STATEMENTS)
+                cur.execute("EXECUTE log_report_stmt (%s, %s, %s, %s, %s)",
+                            (group_id, reporter_name, normalized, r_date, content))
             
-            # 2. 檢查重複
-            cur.execute("""
-                SELECT reporter_name FROM reports 
-                WHERE group_id = %s AND report_date = %s AND normalized_name = %s
-            """, (group_id, r_date, normalized))
+                # 沒有寫入任何列 = 今天已經回報過
+                if cur.fetchone() is None:
+                     return f"⚠️ {reporter_name} 今天已經回報過了！"
             
-            if cur.fetchone():
-                 return f"⚠️ {reporter_name} 今天已經回報過了！"
-
-            # 3. 寫入紀錄
-            cur.execute("""
-                INSERT INTO reports (group_id, reporter_name, normalized_name, report_date, report_content) 
-                VALUES (%s, %s, %s, %s, %s)
-            """, (group_id, reporter_name, normalized, r_date, content))
+                conn.commit()
+                # 回報時可能自動補進名單
+                invalidate_vip_cache(group_id)
+                return f"👌 收到！{reporter_name} ({date_str}) 的心得已登入。\n（給你的乖寶寶貼紙 ⭐）"
             
-            conn.commit()
-            return f"👌 收到！{reporter_name} ({date_str}) 的心得已登入。\n（給你的乖寶寶貼紙 ⭐）"
+        except ValueError:
+            return "❌ 日期格式錯誤 (YYYY.MM.DD)。"
+        except Exception as e:
+            logger.error("LOG ERROR: %s", e)
+            return "💥 記錄失敗，請稍後再試。"
+
+# --- 指令分派 ---
+HELP_TEXT = "🤖 **功能選單**\n📝 回報: `YYYY.MM.DD [姓名]`\n👥 管理: `新增人名`, `刪除人名`, `名單`\n📊 總結: `總結回報 [日期] [姓名(選)]`\n⚙️ AI: `開啟智能模式`, `關閉智能模式`"
+
+def cmd_help(group_id, args):
+    return HELP_TEXT
+
+def cmd_group_id(group_id, args):
+    return f"🆔 本群組 ID 為：\n`{group_id}`\n(請複製起來用於測試指令)"
+
+def cmd_ai_on(group_id, args):
+    return set_group_mode(group_id, True)
+
+def cmd_ai_off(group_id, args):
+    return set_group_mode(group_id, False)
+
+def cmd_summary(group_id, args):
+    # 解析指令: "總結回報 昨天", "總結回報 2025-11-27", "總結回報 27號"
+    cmd_parts = args.split()
+    target_str = cmd_parts[0] if cmd_parts else "昨天"
+    target_name = cmd_parts[1] if len(cmd_parts) > 1 else None # 支援 "總結回報 昨天 彼得"
+
+    # 日期解析
+    date_obj = None
+    today = tw_today()
+    
+    if "昨天" in target_str:
+        date_obj = today - timedelta(days=1)
+    elif "今天" in target_str:
+        date_obj = today
+    elif "前天" in target_str:
+        date_obj = today - timedelta(days=2)
+    else:
+        # 嘗試解析 YYYY.MM.DD 或 MM/DD
+        try:
+            # 簡單正規化
+            t = target_str.replace('/', '-').replace('.', '-')
+            parts = t.split('-')
+            if len(parts) == 2: # MM-DD
+                parts = [today.year] + parts
+            elif "號" in t: # 27號
+                parts = [today.year, today.month, DIGITS_RE.search(t).group(1)]
             
-    except ValueError:
-        return "❌ 日期格式錯誤 (YYYY.MM.DD)。"
-    except Exception as e:
-        print(f"LOG ERROR: {e}", file=sys.stderr)
-        return "💥 記錄失敗，請稍後再試。"
-    finally:
-        conn.close()
+            # 直接轉數字建立日期，不走 strptime 的格式字串解析
+            year, month, day = (int(p) for p in parts)
+            date_obj = date(year, month, day)
+        except:
+            return "❌ 日期格式錯誤，請使用：總結回報 昨天 / 總結回報 2025-11-27"
+
+    d_str = date_obj.strftime('%Y-%m-%d')
+    # 呼叫總結函式 (傳入群組ID以確保隔離)
+    return generate_daily_summary(group_id, d_str, target_name)
+
+def cmd_add_vip(group_id, args):
+    return manage_vip_list(group_id, args, 'ADD') if args else None
+
+def cmd_del_vip(group_id, args):
+    return manage_vip_list(group_id, args, 'DEL') if args else None
+
+def cmd_list_vip(group_id, args):
+    return manage_vip_list(group_id, None, 'LIST')
+
+# 整行查表，取代逐一比對的 if/elif
+COMMAND_TABLE = {
+    "指令": cmd_help, "幫助": cmd_help, "help": cmd_help,
+    "查詢群組ID": cmd_group_id,
+    "開啟智能模式": cmd_ai_on, "關閉智能模式": cmd_ai_off,
+    "總結回報": cmd_summary,
+    "新增人名": cmd_add_vip, "刪除人名": cmd_del_vip,
+    "查詢名單": cmd_list_vip, "名單": cmd_list_vip, "list": cmd_list_vip,
+}
+# 允許指令與參數黏在一起 (例如 "新增人名彼得")
+COMMAND_PREFIXES = ("新增人名", "刪除人名", "總結回報")
+# 原本就不分大小寫的指令只有 help
+LOWERCASE_COMMANDS = frozenset(("help",))
+
+def dispatch_command(group_id, first_line):
+    """依第一行的指令字詞分派，沒有對應指令時回傳 None"""
+    # 只有帶參數的指令 (COMMAND_PREFIXES) 吃後面的字；其他指令必須整行完全相符，
+    # 「help me」、「名單 是什麼」這類句子要留給 AI
+    command = COMMAND_TABLE.get(first_line)
+    if command: return command(group_id, "")
+    if first_line.lower() in LOWERCASE_COMMANDS:
+        return COMMAND_TABLE[first_line.lower()](group_id, "")
+    prefix = next((p for p in COMMAND_PREFIXES if first_line.startswith(p)), None)
+    if not prefix: return None
+    return COMMAND_TABLE[prefix](group_id, first_line[len(prefix):].strip())
 
 # --- Webhook ---
 @app.route("/callback", methods=['POST'])
 def callback():
-    signature = request.headers['X-Line-Signature']
-    body = request.get_data(as_text=True)
+    global dropped_events
+    signature = request.headers.get('X-Line-Signature', '')
+    # 只讀原始 bytes，不解碼成文字也不留快取；驗章與 orjson 解析都直接吃 bytes
+    raw = request.get_data(cache=False)
+    # 空內容或簽章不符直接擋掉，不必解析 JSON
+    if not raw or not signature or not verify_signature(raw, signature):
+        abort(400)
     try:
-        handler.handle(body, signature)
-    except (InvalidSignatureError, LineBotApiError):
+        payload = orjson.loads(raw)
+    except orjson.JSONDecodeError:
         abort(400)
+    if not event_slots.acquire(blocking=False):
+        dropped_events += 1
+        logger.warning("EVENT QUEUE FULL, dropped %d payload(s) so far", dropped_events)
+        return 'OK'
+    executor.submit(dispatch_events, payload).add_done_callback(lambda _: event_slots.release())
     return 'OK'
 
-@handler.add(MessageEvent, message=TextMessage)
+def dispatch_events(payload):
+    """簽章已驗證過，直接把文字訊息事件交給 handle_message (不再經過 WebhookHandler 重驗與 json 解析)"""
+    events = [e for e in payload.get('events', [])
+              if e.get('type') == 'message' and e.get('message', {}).get('type') == 'text']
+
+    # 同一個 POST 帶多個事件時，整批共用一條連線，不必每個事件各自借還
+    with db_connection() if len(events) > 1 else nullcontext():
+        for event_json in events:
+            # 在背景執行緒裡，例外不會有人接，自己記下來
+            try:
+                handle_message(MessageEvent.new_from_json_dict(event_json))
+            except Exception as e:
+                logger.error("EVENT ERROR: %s", e)
+
 def handle_message(event):
     text = event.message.text
-    group_id = None
-    if isinstance(event.source, SourceGroup): group_id = event.source.group_id
-    elif isinstance(event.source, SourceRoom): group_id = event.source.room_id
-    elif isinstance(event.source, SourceUser): group_id = event.source.user_id
+    # 群組 > 聊天室 > 個人，依來源類型取對應 ID
+    source = event.source
+    group_id = getattr(source, 'group_id', None) or getattr(source, 'room_id', None) or getattr(source, 'user_id', None)
     
     if not group_id or group_id in EXCLUDE_GROUP_IDS: return
 
-    processed_text = text.strip().replace('（', '(').replace('）', ')')
-    first_line = processed_text.split('\n')[0].strip()
     reply = None
 
-    # 1. 指令
-    if first_line.lower() in ["指令", "幫助", "help"]:
-        reply = "🤖 **功能選單**\n📝 回報: `YYYY.MM.DD [姓名]`\n👥 管理: `新增人名`, `刪除人名`, `名單`\n📊 總結: `總結回報 [日期] [姓名(選)]`\n⚙️ AI: `開啟智能模式`, `關閉智能模式`"
-    
-    elif first_line == "查詢群組ID":
-        reply = f"🆔 本群組 ID 為：\n`{group_id}`\n(請複製起來用於測試指令)"
-
-    elif first_line == "開啟智能模式": reply = set_group_mode(group_id, True)
-    elif first_line == "關閉智能模式": reply = set_group_mode(group_id, False)
-
-    # 2. 總結回報指令 (整合功能)
-    elif first_line.startswith("總結回報"):
-        # 解析指令: "總結回報 昨天", "總結回報 2025-11-27", "總結回報 27號"
-        cmd_parts = first_line.split()
-        target_str = cmd_parts[1] if len(cmd_parts) > 1 else "昨天"
-        target_name = cmd_parts[2] if len(cmd_parts) > 2 else None # 支援 "總結回報 昨天 彼得"
-
-        # 日期解析
-        date_obj = None
-        current_time = datetime.utcnow() + timedelta(hours=8)
-        
-        if "昨天" in target_str:
-            date_obj = (current_time - timedelta(days=1)).date()
-        elif "今天" in target_str:
-            date_obj = current_time.date()
-        elif "前天" in target_str:
-            date_obj = (current_time - timedelta(days=2)).date()
-        else:
-            # 嘗試解析 YYYY.MM.DD 或 MM/DD
-            try:
-                # 簡單正規化
-                t = target_str.replace('/', '-').replace('.', '-')
-                if len(t.split('-')) == 2: # MM-DD
-                    t = f"{current_time.year}-{t}"
-                elif "號" in t: # 27號
-                    d = re.search(r'(\d+)', t).group(1)
-                    t = f"{current_time.year}-{current_time.month}-{d}"
-                
-                date_obj = datetime.strptime(t, '%Y-%m-%d').date()
-            except:
-                reply = "❌ 日期格式錯誤，請使用：總結回報 昨天 / 總結回報 2025-11-27"
-
-        if date_obj:
-            d_str = date_obj.strftime('%Y-%m-%d')
-            # 呼叫總結函式 (傳入群組ID以確保隔離)
-            reply = generate_daily_summary(group_id, d_str, target_name)
-
-    # 3. 回報與管理
-    if not reply:
-        if first_line.startswith("新增人名"): 
-            name = first_line.replace("新增人名", "").strip()
-            if name: reply = manage_vip_list(group_id, name, 'ADD')
-        
-        elif first_line.startswith("刪除人名"):
-            name = first_line.replace("刪除人名", "").strip()
-            if name: reply = manage_vip_list(group_id, name, 'DEL')
-
-        elif first_line in ["查詢名單", "名單", "list"]:
-            reply = manage_vip_list(group_id, None, 'LIST')
-
-        # 4. 回報匹配 (日期 + 姓名 + 任意內容)
-        match_report = re.match(r"^(\d{4}\.\d{2}\.\d{2})\s*(?:[（(].*?[)）])?\s*([^\n]+)([\s\S]*)", text, re.DOTALL)
+    # 1. 回報匹配 (日期 + 姓名 + 任意內容)：最常見的訊息，先用便宜的前綴檢查
+    if looks_like_report(text):
+        match_report = REPORT_RE.match(text)
         if match_report:
             d_str = match_report.group(1)
             name = match_report.group(2).strip()
             content = text
             if name: reply = log_report(group_id, d_str, name, content)
 
+    # 2. 指令 (查表分派)；指令不會以日期開頭，兩者互斥
+    else:
+        # 只切出第一行，不必把整段訊息替換括號、切成所有行
+        first_line = text.strip().partition('\n')[0].strip().translate(FULLWIDTH_PAREN_TABLE)
+        reply = dispatch_command(group_id, first_line)
+
     # --- AI 處理 (含資料庫檢索) ---
     if not reply and get_group_mode(group_id):
-        # 1. 先嘗試撈取相關資料 (RAG)
-        context_info = get_ai_context(group_id, text)
+        # 1. 先嘗試撈取相關資料 (RAG)；AI 無法使用時回覆不會用到，不必查資料庫
+        context_info = get_ai_context(group_id, text) if AI_ENABLED else ""
         # 2. 將資料與問題一起丟給 AI
-        reply = chat_with_ai(text, context_info)
+        reply = chat_with_ai(group_id, text, context_info)
 
     if reply:
         try:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
         except Exception as e:
-            print(f"REPLY ERROR: {e}", file=sys.stderr)
+            logger.error("REPLY ERROR: %s", e)
 
 # --- 定時排程 ---
 def run_daily_check():
     # 任務 1: 每天晚上 10 點檢查「今天」的進度 (溫柔提醒)
-    print("⏰ Daily check...", file=sys.stderr)
-    subprocess.run(["python", "scheduler.py", "--days-ago", "0"])
+    logger.info("⏰ Daily check...")
+    check_reminders(days_ago=0)
 
 def run_makeup_check():
     # 任務 2: 每天下午 1 點檢查「昨天」的缺交 (奧客模式)
-    print("⏰ Makeup check...", file=sys.stderr)
-    subprocess.run(["python", "scheduler.py", "--days-ago", "1"])
+    logger.info("⏰ Makeup check...")
+    check_reminders(days_ago=1)
 
 scheduler = BackgroundScheduler()
 # 設定 1: 台灣時間 22:00 (UTC 14:00) -> 檢查當日
@@ -484,6 +744,10 @@ scheduler.add_job(run_makeup_check, 'cron', hour=5, minute=0)
 scheduler.start()
 
 if __name__ == "__main__":
+    # 直接 python app.py 時沒有 gunicorn 的 on_starting，自己先跑 schema 檢查
+    if DB_ENABLED:
+        from fix_db import fix_database
+        fix_database(raise_errors=True)
     port = int(os.environ.get("PORT", 8080))
     app.run(host='0.0.0.0', port=port)
 
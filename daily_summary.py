@@ -42,7 +42,6 @@ def run_summary(target_date_str, target_name=None, target_group_id=None, send_to
         print(f"🔍 過濾條件：姓名包含 '{target_name}'", file=sys.stderr)
     
     conn = psycopg2.connect(DB_URL, sslmode='require')
-    cur = conn.cursor()
     
     try:
         # 1. 動態建構 SQL 查詢
@@ -65,8 +64,9 @@ def run_summary(target_date_str, target_name=None, target_group_id=None, send_to
 
         sql += " ORDER BY group_id, created_at ASC"
 
-        cur.execute(sql, tuple(params))
-        rows = cur.fetchall()
+        with conn.cursor() as cur:
+            cur.execute(sql, tuple(params))
+            rows = cur.fetchall()
         
         if not rows:
             print(f"📭 {target_date_str} 沒有找到符合條件的回報紀錄。", file=sys.stderr)
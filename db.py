@@ -0,0 +1,118 @@
+import os
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from psycopg2 import pool, extensions
+
+# --- 資料庫連線 (app 與排程共用) ---
+DATABASE_URL = os.environ.get('DATABASE_URL')
+# 沒設定資料庫時不必每次都嘗試建池再失敗
+DB_ENABLED = bool(DATABASE_URL)
+logger = logging.getLogger("bot")
+
+# --- 連線池 ---
+# 每個 gunicorn worker 各自一個池，上限對應 worker 的 threads 數；可依資料庫方案的連線上限用環境變數調整
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+db_pool = None
+db_pool_lock = threading.Lock()
+
+# 熱門語句在每條連線建立時 PREPARE 一次，之後只送 EXECUTE，省掉每次的 parse/plan
+PREPARED_STATEMENTS = """
+    PREPARE get_group_mode_stmt (text) AS
+        SELECT ai_mode FROM group_configs WHERE group_id = $1;
+    PREPARE log_report_stmt (text, text, text, date, text) AS
+        WITH vip AS (
+            INSERT INTO group_vips (group_id, vip_name, normalized_name)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (group_id, normalized_name) DO NOTHING
+        )
+        INSERT INTO reports (group_id, reporter_name, normalized_name, report_date, report_content)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (group_id, report_date, normalized_name) DO NOTHING
+        RETURNING 1;
+"""
+
+class PreparedConnectionPool(pool.ThreadedConnectionPool):
+    """新開的連線先 PREPARE 好熱門語句再放進池中"""
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(PREPARED_STATEMENTS)
+            conn.commit()
+        except Exception:
+            # super()._connect 已把連線登記進池裡；PREPARE 失敗要撤銷登記並關閉，否則這個名額永遠借不回來
+            if key is not None:
+                self._used.pop(key, None)
+                self._rused.pop(id(conn), None)
+            elif conn in self._pool:
+                self._pool.remove(conn)
+            conn.close()
+            raise
+        return conn
+
+    def _putconn(self, conn, key=None, close=False):
+        # psycopg2 歸還時池內已有 minconn 條就直接關掉；改以 maxconn 為上限，
+        # 尖峰時開過的連線留著重用，不必每次重新 TLS 握手與 PREPARE (呼叫端已持有 self._lock)
+        minconn, self.minconn = self.minconn, self.maxconn
+        try:
+            super()._putconn(conn, key, close)
+        finally:
+            self.minconn = minconn
+
+def get_db_pool():
+    global db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                # keepalive 讓閒置連線不會被 NAT 默默切斷；statement_timeout 避免卡住的查詢吃掉 LINE 的回覆時間
+                db_pool = PreparedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, sslmode='require',
+                    keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+                    options='-c statement_timeout=2500')
+                atexit.register(db_pool.closeall)
+    return db_pool
+
+def get_db_connection():
+    if not DB_ENABLED: return None
+    try:
+        return get_db_pool().getconn()
+    except Exception as e:
+        logger.error("DB CONNECTION ERROR: %s", e)
+        return None
+
+def put_db_connection(conn):
+    """把連線還給連線池 (未結束的交易會被 rollback)，已斷線的直接丟棄"""
+    try:
+        get_db_pool().putconn(conn, close=bool(conn.closed))
+    except Exception as e:
+        logger.error("DB POOL ERROR: %s", e)
+
+db_local = threading.local()
+
+@contextmanager
+def db_connection():
+    """
+    取得連線池連線，離開區塊時 (包含例外) 一定歸還；連線失敗時 yield None。
+    同一執行緒內巢狀使用時沿用外層已取得的連線。
+    """
+    conn = getattr(db_local, 'conn', None)
+    if conn is not None:
+        try:
+            yield conn
+        finally:
+            # 每個操作自己負責 commit；沒 commit 的交易 (失敗或刻意不寫入) 一律 rollback，
+            # 不能被同批次下一個操作的 commit 一起帶進去，批次與單一事件的結果才會一致
+            if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        return
+
+    conn = get_db_connection()
+    db_local.conn = conn
+    try:
+        yield conn
+    finally:
+        db_local.conn = None
+        if conn: put_db_connection(conn)
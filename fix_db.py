@@ -8,39 +8,108 @@ if not DATABASE_URL:
     print("ERROR: DATABASE_URL not found.")
     sys.exit(1)
 
-def fix_database():
+# 同時有多個 dyno / 實例部署時一次只讓一個跑 migration，其他的等它跑完再確認
+MIGRATION_LOCK_ID = 4242
+# 刪除重複回報會動到使用者資料，只在明確設定 DEDUP_REPORTS=1 時才做
+DEDUP_REPORTS = os.environ.get('DEDUP_REPORTS') == '1'
+
+# 同一人同一天多出來的回報 (保留最早寫入 created_at 的那一筆)
+DUPLICATE_REPORTS_SQL = """
+    SELECT ctid FROM (
+        SELECT ctid, row_number() OVER (
+            PARTITION BY group_id, report_date, normalized_name
+            ORDER BY created_at NULLS LAST, ctid
+        ) AS rn
+        FROM reports WHERE normalized_name IS NOT NULL
+    ) d WHERE rn > 1
+"""
+
+def migrate_report_columns(cur):
+    print("🔍 Inspecting reports columns...")
+    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'reports';")
+    r_cols = [row[0] for row in cur.fetchall()]
+
+    # 快速路徑：欄位都已就緒時直接結束，不必每次部署都跑 DDL 與回填
+    if 'normalized_name' in r_cols and 'report_content' in r_cols and 'normalized_reporter_name' not in r_cols:
+        print("✅ Columns already up to date, skipping migration.")
+        return
+
+    if 'normalized_reporter_name' in r_cols and 'normalized_name' not in r_cols:
+        print("🔄 Renaming 'normalized_reporter_name' to 'normalized_name'...")
+        cur.execute("ALTER TABLE reports RENAME COLUMN normalized_reporter_name TO normalized_name;")
+        # 整段在同一個交易裡，r_cols 要跟著更新，否則下面會再 ADD 一次同名欄位而整批 rollback
+        r_cols.append('normalized_name')
+
+    elif 'normalized_reporter_name' in r_cols:
+        print("🗑️ Dropping legacy column 'normalized_reporter_name'...")
+        cur.execute("ALTER TABLE reports DROP COLUMN normalized_reporter_name;")
+
+    if 'normalized_name' not in r_cols:
+        print("➕ Creating 'normalized_name' column for reports...")
+        cur.execute("ALTER TABLE reports ADD COLUMN normalized_name VARCHAR(100) DEFAULT '';")
+
+    if 'report_content' not in r_cols:
+        print("➕ Creating 'report_content' column...")
+        cur.execute("ALTER TABLE reports ADD COLUMN report_content TEXT;")
+
+    print("🔧 Backfilling NULLs in reports...")
+    cur.execute("UPDATE reports SET normalized_name = reporter_name WHERE normalized_name IS NULL OR normalized_name = '';")
+
+def ensure_indexes(cur):
+    # group_vips 的 (group_id, normalized_name) 已有 ON CONFLICT 用的唯一索引，不必再建
+    print("📇 Ensuring indexes...")
+    # 每人每天一筆：log_report 靠這個唯一索引 ON CONFLICT DO NOTHING；總結與催繳也以 (group_id, report_date) 過濾
+    cur.execute("SELECT to_regclass('reports_daily_uniq');")
+    if cur.fetchone()[0] is None:
+        # 有重複回報就建不了唯一索引；清除要另外明確執行，不在啟動時默默刪資料
+        cur.execute(f"SELECT count(*) FROM ({DUPLICATE_REPORTS_SQL}) d;")
+        dup_count = cur.fetchone()[0]
+        if dup_count:
+            if not DEDUP_REPORTS:
+                raise RuntimeError(
+                    f"{dup_count} duplicate report(s) block reports_daily_uniq; "
+                    "run `DEDUP_REPORTS=1 python fix_db.py` once to keep only the earliest report per person per day.")
+            print(f"🧹 Removing {dup_count} duplicate report(s) before adding unique index...")
+            cur.execute(f"DELETE FROM reports WHERE ctid IN ({DUPLICATE_REPORTS_SQL});")
+            print(f"🧹 Removed {cur.rowcount} duplicate report(s).")
+        cur.execute("CREATE UNIQUE INDEX reports_daily_uniq ON reports (group_id, report_date, normalized_name);")
+        # 唯一索引已涵蓋相同欄位，舊的一般索引只是多餘的寫入成本
+        cur.execute("DROP INDEX IF EXISTS reports_dup_idx;")
+    # AI 問某人近況時以 (group_id, normalized_name) 過濾、取 report_date 最新一筆
+    cur.execute("CREATE INDEX IF NOT EXISTS reports_name_idx ON reports (group_id, normalized_name, report_date);")
+    # AI 問「最近」狀況時 ORDER BY created_at DESC LIMIT 10，走索引不必排序
+    cur.execute("CREATE INDEX IF NOT EXISTS reports_recent_idx ON reports (group_id, created_at DESC);")
+
+def fix_database(raise_errors=False):
+    """raise_errors=True (gunicorn on_starting、python app.py) 時 migration 失敗直接中止啟動：
+    log_report_stmt 依賴 reports_daily_uniq，少了它每條連線的 PREPARE 都會失敗"""
     print("Connecting to database...")
     conn = psycopg2.connect(DATABASE_URL, sslmode='require')
     conn.autocommit = True 
-    cur = conn.cursor()
     
     try:
-        print("🔍 Inspecting reports columns...")
-        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'reports';")
-        r_cols = [row[0] for row in cur.fetchall()]\r\n
-        if 'normalized_reporter_name' in r_cols and 'normalized_name' not in r_cols:
-            print("🔄 Renaming 'normalized_reporter_name' to 'normalized_name'...")
-            cur.execute("ALTER TABLE reports RENAME COLUMN normalized_reporter_name TO normalized_name;")
-        
-        elif 'normalized_reporter_name' in r_cols:
-            print("🗑️ Dropping legacy column 'normalized_reporter_name'...")
-            cur.execute("ALTER TABLE reports DROP COLUMN normalized_reporter_name;")
-
-        if 'normalized_name' not in r_cols:
-            print("➕ Creating 'normalized_name' column for reports...")
-            cur.execute("ALTER TABLE reports ADD COLUMN normalized_name VARCHAR(100) DEFAULT '';")
-
-        if 'report_content' not in r_cols:
-            print("➕ Creating 'report_content' column...")
-            cur.execute("ALTER TABLE reports ADD COLUMN report_content TEXT;")
-
-        print("🔧 Backfilling NULLs in reports...")
-        cur.execute("UPDATE reports SET normalized_name = reporter_name WHERE normalized_name IS NULL OR normalized_name = '';")
+        with conn.cursor() as cur:
+            # 別的實例正在 migrate 時等它完成，之後的檢查會走快速路徑，確保啟動時 schema 一定已就緒
+            print("🔒 Waiting for migration lock...")
+            cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_ID,))
 
-        print("✅ Database check complete!")
+            try:
+                # 所有 DDL 包在同一個交易裡：中途失敗整批 rollback，不會留下半套 schema
+                cur.execute("BEGIN;")
+                try:
+                    migrate_report_columns(cur)
+                    ensure_indexes(cur)
+                    cur.execute("COMMIT;")
+                except Exception:
+                    cur.execute("ROLLBACK;")
+                    raise
+                print("✅ Database check complete!")
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_ID,))
         
     except Exception as e:
         print(f"❌ Error: {e}")
+        if raise_errors: raise
     finally:
         conn.close()
 
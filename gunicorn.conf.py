@@ -0,0 +1,17 @@
+import os
+
+# --- gunicorn 設定 (Procfile 只負責啟動) ---
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+# 排程在 app 匯入時啟動，多個 worker 會重複發送提醒，所以固定 1 個 worker
+workers = 1
+
+# 工作幾乎都在等 I/O (Postgres、Gemini、LINE API)，用執行緒讓一個 worker 同時處理多個 webhook
+worker_class = "gthread"
+threads = 8
+
+def on_starting(server):
+    # schema 檢查只在 master 啟動時跑一次，不必另開一個 python 行程，也不會被每個 worker 重跑
+    # migration 失敗就讓 gunicorn 啟動失敗，不要帶著缺索引的 schema 上線
+    from fix_db import fix_database
+    fix_database(raise_errors=True)